@@ -7,8 +7,11 @@ from enum import Enum
 from sys import argv
 
 import yaml
-from voluptuous import Required, Schema, MultipleInvalid, All, Any, Optional, Coerce
+from voluptuous import Required, Schema, MultipleInvalid, All, Any, Optional, Coerce, Range
 
+from capture import CaptureWriter
+from log_utils import setup_logging
+from loop_monitor import LoopMonitor
 from wb_connector import WbConnector
 import uvloop
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -18,6 +21,7 @@ logging.getLogger().setLevel(logging.INFO)  # root
 logger = logging.getLogger(__name__)
 
 STOP = asyncio.Event()
+RELOAD = asyncio.Event()
 
 class ConfigLogLevel(Enum):
     FATAL = 'FATAL'
@@ -38,53 +42,148 @@ LOGLEVEL_MAPPER = {
 config_schema = Schema({
     Optional('general', default={}): {
         Optional('loglevel', default=ConfigLogLevel.WARNING): Coerce(ConfigLogLevel),
+        Optional('loop_lag_threshold_ms', default=500): All(int, Range(min=0)),  # 0 - don't report stalls
+        Optional('log_throttle_sec', default=60): All(int, Range(min=0)),  # Repeated warnings are summarized
     },
     Required('wirenboard'): {
         Required('broker_host'): str,
         Optional('broker_port', default=1883): int,
         Optional('username'): str,
         Optional('password'): str,
-        Optional('client_id', default='wirenboard-mqtt-discovery'): str
+        Optional('client_id', default='wirenboard-mqtt-discovery'): str,
+        Optional('max_devices', default=1000): All(int, Range(min=1)),
+        Optional('split_connections', default=False): bool,
+        Optional('publish_delay_ms', default=1000): All(int, Range(min=0)),
+        Optional('cleanup_delay_ms', default=5000): All(int, Range(min=0)),
+        Optional('exclude_devices', default=[]): [str],
     },
 })
 
+# Settings which can't be applied by SIGHUP, these need reconnect
+RESTART_REQUIRED = ('broker_host', 'broker_port', 'username', 'password', 'client_id', 'split_connections')
+
+
+def load_config(config_file):
+    try:
+        with open(config_file) as f:
+            config_file_content = f.read()
+    except OSError as e:
+        logger.error(e)
+        return None
+
+    try:
+        config = yaml.load(config_file_content, Loader=yaml.FullLoader)
+    except yaml.YAMLError as e:
+        logger.error(e)
+        return None
+    if not config:
+        logger.error('Could not load conf "%s"', config_file)
+        return None
+    try:
+        return config_schema(config)
+    except MultipleInvalid as e:
+        logger.error('Config error')
+        logger.error(e)
+        return None
+
+
+def apply_config(conf, wiren, loop_monitor):
+    logging.getLogger().setLevel(LOGLEVEL_MAPPER[conf['general']['loglevel']])
+    loop_monitor.threshold_sec = conf['general']['loop_lag_threshold_ms'] / 1000
+
+    wiren_conf = conf['wirenboard']
+    wiren.configure(
+        publish_delay_sec=wiren_conf['publish_delay_ms'] / 1000,
+        cleanup_discovery_delay_sec=wiren_conf['cleanup_delay_ms'] / 1000,
+        max_devices=wiren_conf['max_devices'],
+        excluded_devices=wiren_conf['exclude_devices'],
+        log_throttle_sec=conf['general']['log_throttle_sec']
+    )
+
 
 def ask_exit(*args):
     logger.info('Exiting')
     STOP.set()
 
 
-async def main(conf):
-    logging.basicConfig(level=LOGLEVEL_MAPPER[conf['general']['loglevel']])
+def ask_reload(*args):
+    logger.info('Reloading config')
+    RELOAD.set()
+
+
+async def reload_on_signal(config_file, conf, wiren, loop_monitor):
+    while True:
+        await RELOAD.wait()
+        RELOAD.clear()
+
+        new_conf = load_config(config_file)
+        if not new_conf:
+            logger.error('Config is not reloaded')
+            continue
+
+        for key in RESTART_REQUIRED:
+            if new_conf['wirenboard'].get(key) != conf['wirenboard'].get(key):
+                logger.warning("'%s' change requires restart", key)
+
+        apply_config(new_conf, wiren, loop_monitor)
+        conf = new_conf
+
+
+async def main(conf, config_file, capture_file=None):
+    log_listener = setup_logging(LOGLEVEL_MAPPER[conf['general']['loglevel']])
     logging.getLogger('gmqtt').setLevel(logging.ERROR)  # don't need extra messages from mqtt
 
+    loop_monitor = LoopMonitor(asyncio.get_running_loop(), threshold_sec=conf['general']['loop_lag_threshold_ms'] / 1000)
+    loop_monitor.start()
+
     wiren_conf = conf['wirenboard']
 
+    capture = None
+    if capture_file:
+        logger.info('Capturing inbound traffic to "%s"', capture_file)
+        capture = CaptureWriter(capture_file)
+
     logger.info('Starting')
     wiren = WbConnector(
         broker_host=wiren_conf['broker_host'],
         broker_port=wiren_conf['broker_port'],
         username=wiren_conf['username'] if 'username' in wiren_conf else None,
         password=wiren_conf['password'] if 'password' in wiren_conf else None,
-        client_id=wiren_conf['client_id']
+        client_id=wiren_conf['client_id'],
+        max_devices=wiren_conf['max_devices'],
+        capture=capture,
+        split_connections=wiren_conf['split_connections'],
+        loop_monitor=loop_monitor
     )
+    apply_config(conf, wiren, loop_monitor)
+
+    reload_task = asyncio.ensure_future(reload_on_signal(config_file, conf, wiren, loop_monitor))
 
     await wiren.connect()  # FIXME: handle connect exceptions
 
     await STOP.wait()
 
+    reload_task.cancel()
+
     await wiren.disconnect()
 
+    if capture:
+        capture.close()
+
+    loop_monitor.stop()
+    log_listener.stop()
+
 
 def usage():
     print('Usage:\n'
-          '_main.py -c <config_file>')
+          '_main.py -c <config_file> [-w <capture_file>]')
 
 
 if __name__ == '__main__':
     config_file = None
+    capture_file = None
     try:
-        opts, args = getopt.getopt(argv[1:], "hc:")
+        opts, args = getopt.getopt(argv[1:], "hc:w:")
     except getopt.GetoptError:
         usage()
         exit(1)
@@ -94,26 +193,14 @@ if __name__ == '__main__':
             exit()
         elif opt == '-c':
             config_file = arg
+        elif opt == '-w':
+            capture_file = arg
     if not config_file:
         usage()
         exit(1)
 
-    try:
-        with open(config_file) as f:
-            config_file_content = f.read()
-    except OSError as e:
-        logger.error(e)
-        exit(1)
-
-    config = yaml.load(config_file_content, Loader=yaml.FullLoader)
+    config = load_config(config_file)
     if not config:
-        logger.error(f'Could not load conf "{config_file}"')
-        exit(1)
-    try:
-        config = config_schema(config)
-    except MultipleInvalid as e:
-        logger.error('Config error')
-        logger.error(e)
         exit(1)
 
     loop = asyncio.new_event_loop()
@@ -121,5 +208,6 @@ if __name__ == '__main__':
 
     loop.add_signal_handler(signal.SIGINT, ask_exit)
     loop.add_signal_handler(signal.SIGTERM, ask_exit)
+    loop.add_signal_handler(signal.SIGHUP, ask_reload)
 
-    loop.run_until_complete(main(config))
+    loop.run_until_complete(main(config, config_file, capture_file))
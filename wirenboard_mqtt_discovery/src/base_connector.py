@@ -4,53 +4,111 @@ from abc import ABC, abstractmethod
 from gmqtt import Client as MQTTClient
 from gmqtt.mqtt.constants import MQTTv311
 
+from log_utils import ThrottledLog
+
 logger = logging.getLogger(__name__)
 
 
 class BaseConnector(ABC):
 
-    def __init__(self, broker_host, broker_port, username, password, client_id):
+    def __init__(self, broker_host, broker_port, username, password, client_id, split_connections=False):
         self._broker_host = broker_host
         self._broker_port = broker_port
         self._username = username
         self._password = password
         self._client_id = client_id
+        self._split_connections = split_connections
+        self._subscribed_topics = set()  # Subscribed with _subscribe_once() in the current session
+
+        self._dropped_publish_log = ThrottledLog(logger, 'Dropped %s publishes while disconnected (%s)', broker_host)
 
-        self._client = MQTTClient(self._client_id)
+        # Subscriptions (and the inbound flood) go through _client, publishes - through _publish_client.
+        # They are the same client unless connections are split to avoid head-of-line blocking.
+        self._client = MQTTClient(f'{self._client_id}-sub' if split_connections else self._client_id)
         self._client.on_connect = self.__on_connect
         self._client.on_message = self._on_message
         self._client.on_disconnect = self._on_disconnect
         self._client.on_subscribe = self._on_subscribe
 
+        self._publish_client = self._client
+        if split_connections:
+            self._publish_client = MQTTClient(f'{self._client_id}-pub')
+            self._publish_client.on_connect = self.__on_publish_connect
+            self._publish_client.on_disconnect = self._on_disconnect
+
+    @property
+    def _clients(self):
+        return [self._publish_client, self._client] if self._split_connections else [self._client]
+
     async def connect(self):
-        if self._username and self._password:
-            self._client.set_auth_credentials(self._username, self._password)
-        await self._client.connect(self._broker_host, port=self._broker_port, version=MQTTv311)
+        # Publish connection goes first to be ready for publishes caused by the subscriptions
+        for client in self._clients:
+            if self._username and self._password:
+                client.set_auth_credentials(self._username, self._password)
+            await client.connect(self._broker_host, port=self._broker_port, version=MQTTv311)
 
-    def disconnect(self):
-        return self._client.disconnect()
+    async def disconnect(self):
+        for client in self._clients:
+            await client.disconnect()
 
     def __on_connect(self, client, flags, rc, properties):
-        logger.info(f'Connected to {self._broker_host}')
+        logger.info('Connected to %s', self._broker_host)
+        self._subscribed_topics.clear()
+        if not self._split_connections:
+            self._dropped_publish_log.flush()
         return self._on_connect(client)
 
+    def __on_publish_connect(self, client, flags, rc, properties):
+        logger.info('Connected to %s (publish)', self._broker_host)
+        self._dropped_publish_log.flush()
+
     @abstractmethod
     def _on_message(self, client, topic, payload, qos, properties):
         pass
 
     def _on_subscribe(self, client, mid, qos, properties):
-        logger.debug(f'Subscribed ({self._broker_host})')
+        logger.debug('Subscribed (%s)', self._broker_host)
 
-    def _on_disconnect(self, packet, exc=None):
-        logger.warning(f'Disconnected from {self._broker_host}')
+    def _on_disconnect(self, client, packet, exc=None):
+        logger.warning('Disconnected from %s', self._broker_host)
 
     @abstractmethod
     def _on_connect(self, client):
         pass
 
+    @staticmethod
+    def _pause_reading(client, paused):
+        # gmqtt has no flow control, so the socket reading is paused.
+        # Packets already read from the socket are still delivered.
+        connection = getattr(client, '_connection', None)
+        if connection is None or connection.is_closing():
+            return
+        if paused:
+            connection._transport.pause_reading()
+        else:
+            connection._transport.resume_reading()
+
+    def _subscribe_once(self, client, topic, qos=0):
+        # Subscribing again makes the broker resend all the retained messages of the topic
+        if topic in self._subscribed_topics:
+            return
+        self._forget_subscriptions(client, {topic})
+        client.subscribe(topic, qos=qos)
+        self._subscribed_topics.add(topic)
+
+    def _unsubscribe(self, client, *topics):
+        client.unsubscribe(list(topics))
+        self._subscribed_topics.difference_update(topics)
+        self._forget_subscriptions(client, set(topics))
+
+    @staticmethod
+    def _forget_subscriptions(client, topics):
+        # gmqtt never removes unsubscribed topics from client.subscriptions, so it would grow with devices churn
+        client.subscriptions = [subscription for subscription in client.subscriptions if subscription.topic not in topics]
+
     def _publish(self, message_or_topic, payload=None, qos=0, retain=False, **kwargs):
-        if not self._client.is_connected:
-            logger.warning(f"Client not ready ({self._broker_host})")
+        if not self._publish_client.is_connected:
+            self._dropped_publish_log.log('Client not ready (%s), publish dropped', self._broker_host)
             return
-        self._client.publish(message_or_topic, payload, qos, retain, **kwargs)
+        self._publish_client.publish(message_or_topic, payload, qos, retain, **kwargs)
 
@@ -0,0 +1,38 @@
+import struct
+import time
+
+# Record: <timestamp (double)><topic length (ushort)><payload length (uint)><topic><payload>
+_RECORD_HEADER = struct.Struct('<dHI')
+
+
+class CaptureWriter:
+    """Writer of the inbound MQTT traffic, the file holds a single session"""
+
+    def __init__(self, path):
+        # Sessions appended to each other would be replayed as one with a gap between them
+        self._file = open(path, 'wb')
+
+    def write(self, topic, payload, timestamp=None):
+        topic = topic.encode('utf-8')
+        payload = payload or b''
+        self._file.write(_RECORD_HEADER.pack(timestamp or time.time(), len(topic), len(payload)))
+        self._file.write(topic)
+        self._file.write(payload)
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """Yields (timestamp, topic, payload) records of the capture file"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            timestamp, topic_len, payload_len = _RECORD_HEADER.unpack(header)
+            topic = f.read(topic_len).decode('utf-8')
+            payload = f.read(payload_len)
+            if len(payload) < payload_len:
+                return  # Truncated by unclean shutdown
+            yield timestamp, topic, payload
@@ -0,0 +1,68 @@
+import logging
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+
+class _RawQueueHandler(QueueHandler):
+    """Enqueues the record as is, QueueHandler would format it in the calling thread"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level):
+    """Moves formatting and output of log records out of the event loop thread"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    log_queue = SimpleQueue()
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(_RawQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class ThrottledLog:
+    """
+    Logs the first message, then only counts the repeated ones and logs the summary
+    once per interval (or on flush)
+    """
+
+    def __init__(self, logger, summary, *summary_args, level=logging.WARNING, interval_sec=60):
+        self._logger = logger
+        self._summary = summary  # Format with the suppressed messages count as the first argument
+        self._summary_args = summary_args
+        self._level = level
+        self.interval_sec = interval_sec
+
+        self._suppressed = 0
+        self._last_logged = None
+
+    def log(self, msg, *args):
+        if not self._logger.isEnabledFor(self._level):
+            return
+
+        now = time.monotonic()
+        if self._last_logged is not None and now - self._last_logged < self.interval_sec:
+            self._suppressed += 1
+            return
+
+        self.flush()
+        self._logger.log(self._level, msg, *args)
+        self._last_logged = now
+
+    def tick(self):
+        if self._suppressed and time.monotonic() - self._last_logged >= self.interval_sec:
+            self.flush()
+            self._last_logged = time.monotonic()
+
+    def flush(self):
+        if self._suppressed:
+            self._logger.log(self._level, self._summary, f'{self._suppressed:,}', *self._summary_args)
+            self._suppressed = 0
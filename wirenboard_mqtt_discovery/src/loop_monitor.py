@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """
+    Measures event loop scheduling lag with a periodic heartbeat callback.
+    Watchdog thread captures the stack of the loop thread when heartbeat is late over the threshold.
+    """
+    _buckets_ms = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, loop, threshold_sec=0.5, interval_sec=0.25):
+        self._loop = loop
+        self.threshold_sec = threshold_sec
+        self._interval_sec = interval_sec
+
+        self._histogram = [0] * (len(self._buckets_ms) + 1)  # The last one is for lags over the last bucket
+        self._max_lag_sec = 0
+        self._stalls = 0
+
+        self._loop_thread_id = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._handle = None
+        self._expected_beat = None
+        self._last_beat = None
+        self._stall_reported = False
+
+    def start(self):
+        """Must be called from the loop thread"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._schedule_beat()
+
+        self._watchdog = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle:
+            self._handle.cancel()
+        if self._watchdog:
+            self._watchdog.join()
+        logger.info('Event loop lag: %s', self.stats())
+
+    def stats(self):
+        buckets = {f'<{b}ms': count for b, count in zip(self._buckets_ms, self._histogram)}
+        buckets[f'>={self._buckets_ms[-1]}ms'] = self._histogram[-1]
+        return {
+            'max_lag_ms': round(self._max_lag_sec * 1000, 1),
+            'stalls': self._stalls,
+            'histogram': buckets,
+        }
+
+    def _schedule_beat(self):
+        self._expected_beat = time.monotonic() + self._interval_sec
+        self._handle = self._loop.call_later(self._interval_sec, self._beat)
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(now - self._expected_beat, 0)
+        self._last_beat = now
+
+        lag_ms = lag * 1000
+        for i, bucket in enumerate(self._buckets_ms):
+            if lag_ms < bucket:
+                self._histogram[i] += 1
+                break
+        else:
+            self._histogram[-1] += 1
+        self._max_lag_sec = max(self._max_lag_sec, lag)
+
+        if self._stall_reported:
+            logger.warning('Event loop was stalled for %.3fs', lag)
+            self._stall_reported = False
+
+        self._schedule_beat()
+
+    def _watch(self):
+        while not self._stopped.wait(self._interval_sec):
+            if self._stall_reported or not self.threshold_sec:
+                continue
+
+            late_sec = time.monotonic() - self._last_beat - self._interval_sec
+            if late_sec < self.threshold_sec:
+                continue
+
+            self._stall_reported = True
+            self._stalls += 1
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            task = asyncio.current_task(self._loop)
+            logger.warning('Event loop is stalled for %.3fs, running task: %s\n%s',
+                           late_sec, task, ''.join(traceback.format_stack(frame)) if frame else '')
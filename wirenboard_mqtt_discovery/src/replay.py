@@ -0,0 +1,270 @@
+import asyncio
+import getopt
+import hashlib
+import logging
+import time
+import tracemalloc
+from collections import OrderedDict
+from sys import argv
+
+from gmqtt import Client as MQTTClient, Subscription
+from gmqtt.mqtt.constants import MQTTv311
+from gmqtt.storage import HeapPersistentStorage
+
+from capture import read_capture
+from log_utils import setup_logging
+from wb_connector import WbConnector
+import uvloop
+asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+logger = logging.getLogger(__name__)
+
+
+class FakeClient:
+    """Local stand-in of gmqtt client, records everything WbConnector publishes"""
+    is_connected = True
+
+    def __init__(self):
+        self.publishes = []
+        self.subscriptions = []
+
+    # Like gmqtt, keeps subscriptions until they are removed by the connector
+    def subscribe(self, topic, qos=0, **kwargs):
+        self.subscriptions.append(Subscription(topic, qos=qos))
+
+    def unsubscribe(self, topic, **kwargs):
+        pass
+
+    def publish(self, message_or_topic, payload=None, qos=0, retain=False, **kwargs):
+        self.publishes.append((time.monotonic(), message_or_topic, payload))
+
+
+class AckTimingStorage(HeapPersistentStorage):
+    """In-flight QoS 1 messages storage of gmqtt client which measures publish ack latency"""
+
+    def __init__(self, timeout=5):
+        super().__init__(timeout)
+        self._pushed = {}
+        self.latencies = []
+        self.last_ack = None
+
+    def push_message_nowait(self, mid, raw_package):
+        self._pushed[mid] = time.monotonic()
+        return super().push_message_nowait(mid, raw_package)
+
+    async def remove_message_by_mid(self, mid):
+        pushed = self._pushed.pop(mid, None)
+        if pushed is not None:
+            self.last_ack = time.monotonic()
+            self.latencies.append(self.last_ack - pushed)
+        await super().remove_message_by_mid(mid)
+
+
+async def wait_acked(client):
+    while not await client._persistent_storage.is_empty:
+        await asyncio.sleep(0.05)
+
+
+async def wait_idle(connector, settle_sec=0.5):
+    """Waits until nothing is received, queued or scheduled for settle_sec"""
+    while True:
+        received = connector.ingest_stats['received']
+        await asyncio.sleep(settle_sec)
+        stats = connector.ingest_stats
+        if stats['received'] == received and not stats['depth'] \
+                and all(task.done() for task in connector._async_tasks.values()):
+            return
+
+
+class LogCounter:
+    records = 0
+
+    def reset(self):
+        self.records = 0
+
+    def __call__(self, record):
+        self.records += 1
+        return True
+
+
+async def replay(capture_file, speed, log_counter):
+    """Prints the report, returns (fed in, CPU time) seconds"""
+    records = list(read_capture(capture_file))
+    if not records:
+        logger.error('Nothing to replay in "%s"', capture_file)
+        return 0, 0
+
+    client = FakeClient()
+    connector = WbConnector('localhost', 1883, None, None, 'wirenboard-mqtt-discovery-replay')
+    connector._client._resend_task.cancel()  # Never connected, replaced with the fake one
+    connector._client = connector._publish_client = client
+
+    tracemalloc.start()
+    started = time.monotonic()
+    started_cpu = time.process_time()
+    connector._on_connect(client)
+
+    first_timestamp = records[0][0]
+    for timestamp, topic, payload in records:
+        if speed:
+            delay = started + (timestamp - first_timestamp) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif connector.ingest_stats['depth'] >= connector._ingest_batch_size:
+            await asyncio.sleep(0)
+        connector._on_message(client, topic, payload, 1, {})
+    fed = time.monotonic()
+
+    await wait_idle(connector)
+    cpu = time.process_time() - started_cpu
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Control command results contain timings, so they are left out
+    control_prefix = connector.control_topic[:-1]
+    digest = hashlib.sha1()
+    for _, topic, payload in client.publishes:
+        if not topic.startswith(control_prefix):
+            digest.update(f'{topic}\0{payload}\0'.encode('utf-8'))
+
+    controls = sum(len(device.controls) for device in connector._devices.values())
+    print(f'Messages:      {len(records)} ({records[-1][0] - first_timestamp:.1f}s captured)\n'
+          f'Fed in:        {fed - started:.3f}s\n'
+          f'CPU time:      {cpu:.3f}s\n'
+          f'Log records:   {log_counter.records}\n'
+          f'Publishes:     {len(client.publishes)} '
+          f'({sum(1 for _, _, payload in client.publishes if payload is None)} cleared)\n'
+          f'Last publish:  {client.publishes[-1][0] - started if client.publishes else 0:.3f}s\n'
+          f'Publish hash:  {digest.hexdigest()}\n'
+          f'Devices:       {len(connector._devices)} ({controls} controls)\n'
+          f'Config topics: {len(connector._config_topics)}\n'
+          f'Subscriptions: {len(client.subscriptions)}\n'
+          f'Ingest:        {connector.ingest_stats}\n'
+          f'Memory:        {current_memory / 1024:.0f} KiB ({peak_memory / 1024:.0f} KiB peak)')
+    return fed - started, cpu
+
+
+async def log_overhead(capture_file, speed, loglevel, log_counter):
+    # CPU time includes formatting in the log listener thread, fed in - only the event loop side
+    results = []
+    for level in (logging.CRITICAL + 1, loglevel):
+        print(f'--- Logging {"off" if level > logging.CRITICAL else "at " + logging.getLevelName(level)}')
+        logging.getLogger().setLevel(level)
+        log_counter.reset()
+        results.append(await replay(capture_file, speed, log_counter))
+
+    (fed_off, cpu_off), (fed_on, cpu_on) = results
+    print(f'--- Log overhead\n'
+          f'Fed in:        {fed_on - fed_off:+.3f}s ({(fed_on - fed_off) / (fed_off or 1) * 100:+.1f}%)\n'
+          f'CPU time:      {cpu_on - cpu_off:+.3f}s ({(cpu_on - cpu_off) / (cpu_off or 1) * 100:+.1f}%)')
+
+
+async def benchmark(capture_file, broker_host, broker_port, split_connections):
+    # The broker keeps the last retained value of each topic
+    retained = OrderedDict()
+    for _, topic, payload in read_capture(capture_file):
+        retained[topic] = payload
+    retained = OrderedDict((topic, payload) for topic, payload in retained.items() if payload)
+
+    feeder = MQTTClient('wirenboard-mqtt-discovery-feeder')
+    await feeder.connect(broker_host, port=broker_port, version=MQTTv311)
+    for topic, payload in retained.items():
+        feeder.publish(topic, payload, qos=1, retain=True)
+    await wait_acked(feeder)
+
+    connector = WbConnector(broker_host, broker_port, None, None, 'wirenboard-mqtt-discovery-bench',
+                            split_connections=split_connections)
+    storage = AckTimingStorage()
+    connector._publish_client._persistent_storage = storage
+
+    started = time.monotonic()
+    await connector.connect()
+    while not connector._async_tasks:  # on_connect callback may be called after connect()
+        await asyncio.sleep(0.01)
+    await wait_idle(connector, settle_sec=2)  # Broker may take a while to start sending retained messages
+    await wait_acked(connector._publish_client)
+
+    latencies = sorted(storage.latencies) or [0]
+    print(f'Connections:   {"split" if split_connections else "single"}\n'
+          f'Retained:      {len(retained)} topics\n'
+          f'Discovery:     {(storage.last_ack or started) - started:.3f}s to the last publish ack\n'
+          f'Acked:         {len(storage.latencies)} publishes\n'
+          f'Ack latency:   p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms\n'
+          f'Ingest:        {connector.ingest_stats}')
+
+    # Don't leave anything retained on the broker
+    published_topics = list(connector._config_topics)
+    for device in connector._devices.values():
+        published_topics += [f'/devices/{device.id}/controls/{control_id}/availability' for control_id in device.controls]
+    await connector.disconnect()
+    for topic in list(retained) + published_topics:
+        feeder.publish(topic, None, qos=1, retain=True)
+    await wait_acked(feeder)
+    await feeder.disconnect()
+
+
+def usage():
+    print('Usage:\n'
+          'replay.py -f <capture_file> [-s <speed>] [-l <loglevel>] [-o]\n'
+          'replay.py -f <capture_file> -b <broker_host>[:<broker_port>] [-d] [-l <loglevel>]\n'
+          '  speed: replay rate relative to capture (1 - realtime), "max" by default\n'
+          '  loglevel: DEBUG/INFO/WARNING/ERROR/FATAL, WARNING by default\n'
+          '  -b: benchmark discovery against a real (test!) broker, capture is published there as retained\n'
+          '  -d: use split subscribe/publish connections for the benchmark\n'
+          '  -o: measure log overhead, replay with logging off and then at the loglevel')
+
+
+if __name__ == '__main__':
+    capture_file = None
+    speed = None
+    loglevel = logging.WARNING
+    broker = None
+    split_connections = False
+    overhead = False
+    try:
+        opts, args = getopt.getopt(argv[1:], "hf:s:l:b:do")
+    except getopt.GetoptError:
+        usage()
+        exit(1)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            exit()
+        elif opt == '-f':
+            capture_file = arg
+        elif opt == '-s':
+            try:
+                speed = None if arg == 'max' else float(arg)
+            except ValueError:
+                usage()
+                exit(1)
+        elif opt == '-l':
+            loglevel = logging.getLevelName(arg.upper())
+            if not isinstance(loglevel, int):
+                usage()
+                exit(1)
+        elif opt == '-b':
+            host, _, port = arg.partition(':')
+            broker = (host, int(port) if port else 1883)
+        elif opt == '-d':
+            split_connections = True
+        elif opt == '-o':
+            overhead = True
+    if not capture_file:
+        usage()
+        exit(1)
+
+    # Log overhead is measured with the same queue handler as the add-on uses
+    log_listener = setup_logging(loglevel)
+    counter = LogCounter()
+    logging.getLogger().handlers[0].addFilter(counter)
+
+    if broker:
+        asyncio.run(benchmark(capture_file, *broker, split_connections))
+    elif overhead:
+        asyncio.run(log_overhead(capture_file, speed, loglevel, counter))
+    else:
+        asyncio.run(replay(capture_file, speed, counter))
+
+    log_listener.stop()
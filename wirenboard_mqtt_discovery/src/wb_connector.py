@@ -2,10 +2,13 @@ import asyncio
 import json
 import logging
 import re
+import time
 
+from collections import OrderedDict, deque
 from json.decoder import JSONDecodeError
 
 from base_connector import BaseConnector
+from log_utils import ThrottledLog
 from wb_entities import WbDevice, WbControl
 
 logger = logging.getLogger(__name__)
@@ -19,20 +22,55 @@ class WbConnector(BaseConnector):
 
     _subscribe_qos = 1
 
+    # Devices without own meta, they are never evicted
+    _system_devices = OrderedDict([
+        ('buzzer', 'WB Buzzer'),
+        ('alarms', 'WB Alarms'),
+        ('hwmon', 'WB HW Monitor'),
+        ('metrics', 'WB Metrics'),
+        ('system', 'WB System'),
+        ('network', 'WB Network'),
+        ('power_status', 'WB Power Status'),
+        ('knx', 'KNX'),
+    ])
+    _evict_grace_sec = 60  # Time for the device to get its controls after announcement
+    _refused_devices_limit = 1000  # Remembered to be retried when devices limit frees up
+
     _config_qos = 1
     _config_retain = True
 
     _availability_qos = 1
     _availability_retain = True
 
+    _control_qos = 1
+    _control_diff_timeout_sec = 30  # Time to receive retained configs from the broker
+
+    _ingest_queue_size = 50000  # Messages received but not processed yet, reading is paused above it
+    _ingest_batch_size = 1000  # Messages processed per event loop iteration
+
     @property
     def discovery_topic(self):
         return f'{self._discovery_prefix}/+/{self._discovery_node_id}/+/config'
 
-    def __init__(self, broker_host, broker_port, username, password, client_id):
-        super().__init__(broker_host, broker_port, username, password, client_id)
+    @property
+    def control_topic(self):
+        return f'{self._discovery_prefix}/{self._discovery_node_id}/control/+'
+
+    @property
+    def diff_marker_topic(self):
+        return f'{self._discovery_prefix}/{self._discovery_node_id}/control/diff/marker'
+
+    def __init__(self, broker_host, broker_port, username, password, client_id, max_devices=None, capture=None,
+                 split_connections=False, loop_monitor=None):
+        super().__init__(broker_host, broker_port, username, password, client_id, split_connections)
+
+        self._capture = capture  # CaptureWriter of the inbound traffic
+        self._loop_monitor = loop_monitor  # Its stats are reported by 'dump' control command
 
-        self._devices = {}
+        self._max_devices = max_devices  # None means unlimited, system devices are not counted
+        self._refused_devices = OrderedDict()  # Refused at the devices limit, oldest first
+        self._excluded_devices = set()  # Tracked in the model, but not published to HA
+        self._devices = OrderedDict()  # Least recently announced first
         self._config_topics = {}
 
         topic_id_pattern = r"([-:\w\s()]+)"
@@ -40,23 +78,159 @@ class WbConnector(BaseConnector):
         self._control_meta_topic_re = re.compile(r"/devices/" + topic_id_pattern + r"/controls/" + topic_id_pattern + r"/meta$")
         self._control_meta_error_topic_re = re.compile(r"/devices/" + topic_id_pattern + r"/controls/" + topic_id_pattern + r"/meta/error")
         self._discovery_topic_re = re.compile(self._discovery_prefix + r"/" + topic_id_pattern + r"/" + self._discovery_node_id + r"/" + topic_id_pattern + r"/config")
+        self._control_topic_re = re.compile(self._discovery_prefix + r"/" + self._discovery_node_id + r"/control/(\w+)$")
         self._async_tasks = {}
+        self._startup_discovery = False  # Retained configs are collected to be cleaned up until devices are subscribed
+        self._retained_configs = None  # Collected by 'diff' control command
+        self._diff_marker = None  # (payload, future) of the message which ends collecting of 'diff'
+        self._diff_markers_sent = 0
+        self._control_commands = {
+            'dump': self._control_dump,
+            'diff': self._control_diff,
+            'republish': self._control_republish,
+            'purge': self._control_purge,
+        }
+
+        self._ingest_client = None
+        self._ingest_queue = deque()
+        self._ingest_scheduled = False
+        self._ingest_paused = False
+        self._dirty_devices = OrderedDict()  # Ordered to keep publishes deterministic
+        self._ingest_stats = {
+            'received': 0,
+            'processed': 0,
+            'collapsed': 0,
+            'paused': 0,
+            'batches': 0,
+            'max_depth': 0,
+        }
+
+        self._malformed_topic_log = ThrottledLog(logger, 'Suppressed %s more mallformed topics')
+        self._malformed_json_log = ThrottledLog(logger, 'Suppressed %s more mallformed JSON payloads')
+        self._devices_limit_log = ThrottledLog(logger, 'Ignored %s more devices, devices limit reached')
+        self._orphan_control_log = ThrottledLog(logger, 'Suppressed %s more messages about controls without device')
+        self._throttled_logs = [
+            self._dropped_publish_log,
+            self._malformed_topic_log,
+            self._malformed_json_log,
+            self._devices_limit_log,
+            self._orphan_control_log,
+        ]
+
+    @property
+    def ingest_stats(self):
+        return dict(self._ingest_stats, depth=len(self._ingest_queue))
+
+    def configure(self, publish_delay_sec=None, cleanup_discovery_delay_sec=None, max_devices=None,
+                  excluded_devices=None, log_throttle_sec=None):
+        """Applies settings which can be changed without reconnecting, None keeps the current value"""
+        if publish_delay_sec is not None:
+            self._async_delay_sec = publish_delay_sec
+        if cleanup_discovery_delay_sec is not None:
+            self._cleanup_discovery_delay_sec = cleanup_discovery_delay_sec
+        if max_devices is not None:
+            self._max_devices = max_devices
+            if self._ingest_client:
+                self._retry_refused_devices(self._ingest_client)
+        if log_throttle_sec is not None:
+            for throttled_log in self._throttled_logs:
+                throttled_log.interval_sec = log_throttle_sec
+
+        if excluded_devices is not None:
+            changed_devices = self._excluded_devices.symmetric_difference(excluded_devices)
+            self._excluded_devices = set(excluded_devices)
+
+            # Newly excluded devices are cleaned up, newly included ones are published
+            for device_id in sorted(changed_devices):
+                if device_id in self._devices:
+                    self.publish_config(device_id)
 
     def _on_connect(self, client):
-        self._on_device_meta_change(client, 'buzzer', {'driver': 'system', 'title': {'en': 'WB Buzzer'}})
-        self._on_device_meta_change(client, 'alarms', {'driver': 'system', 'title': {'en': 'WB Alarms'}})
-        self._on_device_meta_change(client, 'hwmon', {'driver': 'system', 'title': {'en': 'WB HW Monitor'}})
-        self._on_device_meta_change(client, 'metrics', {'driver': 'system', 'title': {'en': 'WB Metrics'}})
-        self._on_device_meta_change(client, 'system', {'driver': 'system', 'title': {'en': 'WB System'}})
-        self._on_device_meta_change(client, 'network', {'driver': 'system', 'title': {'en': 'WB Network'}})
-        self._on_device_meta_change(client, 'power_status', {'driver': 'system', 'title': {'en': 'WB Power Status'}})
-        self._on_device_meta_change(client, 'knx', {'driver': 'system', 'title': {'en': 'KNX'}})
-
-        client.subscribe(self.discovery_topic, qos=self._subscribe_qos)
+        for device_id, title in self._system_devices.items():
+            self._on_device_meta_change(client, device_id, {'driver': 'system', 'title': {'en': title}})
+
+        self._startup_discovery = True
+        self._subscribe_once(client, self.discovery_topic, qos=self._subscribe_qos)
+        self._subscribe_once(client, self.control_topic, qos=self._control_qos)
         self.subscribe_to_devices(client)
 
+    def _on_disconnect(self, client, packet, exc=None):
+        super()._on_disconnect(client, packet, exc)
+        if client is self._client:
+            self._ingest_paused = False  # Reading of the next connection starts unpaused
+
     def _on_message(self, client, topic, payload, qos, properties):
         # print(f'RECV MSG: {topic}', payload)
+        # Runs inside gmqtt read loop, so only enqueue here, see _drain_ingest()
+        if self._capture:
+            self._capture.write(topic, payload)
+
+        self._ingest_client = client
+
+        # Commands must not be collapsed with each other, and they are rare
+        control_topic_match = self._control_topic_re.match(topic)
+        if control_topic_match:
+            asyncio.get_event_loop().call_soon(self._on_control_command, control_topic_match.group(1), payload)
+            return
+
+        stats = self._ingest_stats
+        stats['received'] += 1
+
+        # Nothing is dropped, retained metas wouldn't be received again
+        self._ingest_queue.append((topic, payload))
+        stats['max_depth'] = max(stats['max_depth'], len(self._ingest_queue))
+
+        if len(self._ingest_queue) >= self._ingest_queue_size:
+            if not self._ingest_paused:
+                logger.info('Ingest queue is full, reading paused')
+                stats['paused'] += 1
+                self._ingest_paused = True
+            # gmqtt stream reader resumes the socket reading on its own, so it's paused again on every message
+            self._pause_reading(client, True)
+
+        if not self._ingest_scheduled:
+            self._ingest_scheduled = True
+            asyncio.get_event_loop().call_soon(self._drain_ingest)
+
+    def _drain_ingest(self):
+        queue = self._ingest_queue
+        batch = OrderedDict()
+        count = min(len(queue), self._ingest_batch_size)
+
+        # Retained metas are repeated quite often, only the last value of the topic matters
+        for _ in range(count):
+            topic, payload = queue.popleft()
+            batch[topic] = payload
+
+        stats = self._ingest_stats
+        stats['batches'] += 1
+        stats['processed'] += count
+        stats['collapsed'] += count - len(batch)
+
+        for topic, payload in batch.items():
+            self._handle_message(self._ingest_client, topic, payload)
+
+        # Each touched device is republished once per batch
+        for device_id in self._dirty_devices:
+            self.publish_config(device_id)
+        self._dirty_devices.clear()
+
+        for throttled_log in self._throttled_logs:
+            throttled_log.tick()
+
+        logger.debug('Ingested %d messages (%d collapsed), queue depth %d', count, count - len(batch), len(queue))
+
+        if self._ingest_paused and len(queue) <= self._ingest_queue_size // 2:
+            logger.info('Ingest queue is drained, reading resumed')
+            self._ingest_paused = False
+            self._pause_reading(self._ingest_client, False)
+
+        if queue:
+            asyncio.get_event_loop().call_soon(self._drain_ingest)
+        else:
+            self._ingest_scheduled = False
+
+    def _handle_message(self, client, topic, payload):
         payload = payload.decode("utf-8")
         discovery_topic_match = self._discovery_topic_re.match(topic)
         device_topic_match = self._device_meta_topic_re.match(topic)
@@ -64,18 +238,28 @@ class WbConnector(BaseConnector):
         control_meta_error_topic_match = self._control_meta_error_topic_re.match(topic)
 
         try:
-            if discovery_topic_match:
+            if topic == self.diff_marker_topic:
+                self._on_diff_marker(payload)
+            elif discovery_topic_match and self._retained_configs is not None:
+                self._retained_configs[discovery_topic_match.group(0)] = json.loads(payload) if payload else None
+            elif discovery_topic_match and self._startup_discovery:
                 self._on_discovery_topic_change(client, discovery_topic_match.group(0))
+            elif discovery_topic_match:
+                pass  # Received after 'diff' has finished, unknown configs are cleaned up only at startup
+            elif device_topic_match and not payload:
+                self._on_device_remove(client, device_topic_match.group(1))
             elif device_topic_match:
                 self._on_device_meta_change(client, device_topic_match.group(1), json.loads(payload))
+            elif control_meta_topic_match and not payload:
+                self._on_control_remove(client, control_meta_topic_match.group(1), control_meta_topic_match.group(2))
             elif control_meta_topic_match:
                 self._on_control_meta_change(client, control_meta_topic_match.group(1), control_meta_topic_match.group(2), json.loads(payload))
             elif control_meta_error_topic_match:
                 self._on_control_meta_error_change(control_meta_error_topic_match.group(1), control_meta_error_topic_match.group(2), payload)
             else:
-                logger.warning(f"Mallformed topic: ({topic})")
+                self._malformed_topic_log.log('Mallformed topic: (%s)', topic)
         except JSONDecodeError as e:
-            logger.warning(f'Mallformed JSON payload: {topic}, {payload}, {e}')
+            self._malformed_json_log.log('Mallformed JSON payload: %s, %s, %s', topic, payload, e)
 
     def _on_discovery_topic_change(self, client, topic):
         # print(f'DISCOVERY: {topic}')
@@ -85,16 +269,91 @@ class WbConnector(BaseConnector):
 
     def _on_device_meta_change(self, client, device_id, meta):
         # print(f'DEVICE: {device_id} / {meta}')
+        self._forget_retried_device(client, device_id)
         if device_id not in self._devices:
+            if device_id not in self._system_devices and not self._ensure_device_capacity(client):
+                self._devices_limit_log.log("Devices limit (%s) reached, device '%s' ignored.", self._max_devices, device_id)
+                self._refused_devices[device_id] = True
+                if len(self._refused_devices) > self._refused_devices_limit:
+                    self._refused_devices.popitem(last=False)
+                return
+            self._refused_devices.pop(device_id, None)
             self._devices[device_id] = WbDevice(device_id)
             client.subscribe('/devices/' + device_id + '/controls/+/meta', qos=self._subscribe_qos)
+        else:
+            self._devices.move_to_end(device_id)
 
         self._devices[device_id].meta = meta
+        self._devices[device_id].announced_at = time.monotonic()
+
+    def _on_device_remove(self, client, device_id):
+        # print(f'DEVICE REMOVED: {device_id}')
+        self._forget_retried_device(client, device_id)
+        self._refused_devices.pop(device_id, None)
+        if device_id not in self._devices:
+            return
+
+        logger.info("[%s] device removed", device_id)
+        self._remove_device(client, device_id)
+        self._retry_refused_devices(client)
+
+    @property
+    def _tracked_devices_count(self):
+        return len(self._devices) - sum(1 for device_id in self._system_devices if device_id in self._devices)
+
+    def _ensure_device_capacity(self, client):
+        if self._max_devices is None or self._tracked_devices_count < self._max_devices:
+            return True
+
+        # Evict the least recently announced device which didn't get any control for a while,
+        # i.e. the device that was announced and then vanished
+        announced_before = time.monotonic() - self._evict_grace_sec
+        for device_id, device in self._devices.items():
+            if device.announced_at > announced_before:
+                break  # The rest are announced even later
+            if not device.controls and device_id not in self._system_devices:
+                logger.info("[%s] device evicted", device_id)
+                self._remove_device(client, device_id)
+                return True
+
+        return False
+
+    def _retry_refused_devices(self, client):
+        # Retained meta is not sent again by the wildcard subscription, so the device own topic is subscribed
+        free = len(self._refused_devices)
+        if self._max_devices is not None:
+            free = min(free, self._max_devices - self._tracked_devices_count)
+        for _ in range(free):
+            device_id, _ = self._refused_devices.popitem(last=False)
+            logger.info("[%s] retrying refused device", device_id)
+            self._subscribe_once(client, '/devices/' + device_id + '/meta', qos=self._subscribe_qos)
+
+    def _forget_retried_device(self, client, device_id):
+        # The rest of the device messages come through the wildcard subscription
+        topic = '/devices/' + device_id + '/meta'
+        if topic in self._subscribed_topics:
+            self._unsubscribe(client, topic)
+
+    def _remove_device(self, client, device_id):
+        device = self._devices.pop(device_id)
+        self._dirty_devices.pop(device_id, None)
+        self._cancel_task(f"{device_id}_config")
+
+        topics = ['/devices/' + device_id + '/controls/+/meta']
+        for control_id in device.controls:
+            topics.append('/devices/' + device_id + '/controls/' + control_id + '/meta/error')
+            self._clear_availability_sync(device_id, control_id)
+        self._unsubscribe(client, *topics)
+
+        for topic in sorted(device.config_topics):
+            self._config_topics[topic] = False
+        if device.config_topics:
+            self.cleanup_discovery()
 
     def _on_control_meta_change(self, client, device_id, control_id, meta):
         # print(f'CONTROL: {device_id} / {control_id} / {meta}')
         if device_id not in self._devices:
-            logger.warning(f"Control '{control_id}' without device '{device_id}'.")
+            self._orphan_control_log.log("Control '%s' without device '%s'.", control_id, device_id)
             return
 
         device = self._devices[device_id]
@@ -105,18 +364,35 @@ class WbConnector(BaseConnector):
 
         device.controls[control_id].meta = meta
 
-        self.publish_config(device_id)
+        self._dirty_devices[device_id] = True
+
+    def _on_control_remove(self, client, device_id, control_id):
+        # print(f'CONTROL REMOVED: {device_id} / {control_id}')
+        if device_id not in self._devices:
+            return
+
+        device = self._devices[device_id]
+
+        if control_id not in device.controls:
+            return
+
+        logger.info("[%s/%s] control removed", device_id, control_id)
+        self._unsubscribe(client, '/devices/' + device_id + '/controls/' + control_id + '/meta/error')
+        self._clear_availability_sync(device_id, control_id)
+        del device.controls[control_id]
+
+        self._dirty_devices[device_id] = True
 
     def _on_control_meta_error_change(self, device_id, control_id, meta):
         # print(f'ERROR: {device_id} / {control_id} / {meta}')
         if device_id not in self._devices:
-            logger.warning(f"Error for '{control_id}' without device '{device_id}'.")
+            self._orphan_control_log.log("Error for '%s' without device '%s'.", control_id, device_id)
             return
 
         device = self._devices[device_id]
 
         if control_id not in device.controls:
-            logger.warning(f"Error without device {device_id} / {control_id}'.")
+            self._orphan_control_log.log("Error without device %s / %s'.", device_id, control_id)
             return
 
         self._publish_availability_sync(device_id, control_id, True if not meta else False)
@@ -145,46 +421,230 @@ class WbConnector(BaseConnector):
 
     def _run_task(self, task_id, task):
         loop = asyncio.get_event_loop()
-        if task_id in self._async_tasks:
-            self._async_tasks[task_id].cancel()
+        self._cancel_task(task_id)
         self._async_tasks[task_id] = loop.create_task(task)
 
-    def _subscribe_to_devices_sync(self, client):
-        client.unsubscribe(self.discovery_topic)
-        client.subscribe('/devices/+/meta', qos=self._subscribe_qos)
+    def _cancel_task(self, task_id):
+        task = self._async_tasks.pop(task_id, None)
+        if task:
+            task.cancel()
 
-    def _publish_config_sync(self, device_id):
-        if device_id not in self._devices:
-            return
+    def _subscribe_to_devices_sync(self, client):
+        self._startup_discovery = False
+        if self.discovery_topic in self._subscribed_topics:
+            self._unsubscribe(client, self.discovery_topic)
+        self._subscribe_once(client, '/devices/+/meta', qos=self._subscribe_qos)
 
-        device = self._devices[device_id]
+    def _device_configs(self, device):
+        """Returns {control_id: (ha_control, topic, payload)} of the device"""
         device_payload = device.config_payload()
+        res = OrderedDict()
 
         for control_id, control in device.ha_controls().items():
-            for wb_entity in control.wb_entities:
-                if not wb_entity.availability_published:
-                    self._publish_availability_sync(device_id, wb_entity.id, True)
-
             control_payload = control.config_payload()
             control_payload['device'] = device_payload
 
             # Topic path: <discovery_topic>/<component>/[<node_id>/]<object_id>/config
             topic = self._discovery_prefix + '/' + control.type + '/' + self._discovery_node_id + '/' + control.ha_id + '/config'
 
-            logger.info(f"[{device_id}/{control_id}] publish config to '{topic}'")
+            res[control_id] = (control, topic, control_payload)
+        return res
+
+    def _publish_config_sync(self, device_id, only_control_id=None):
+        if device_id not in self._devices:
+            return
+
+        device = self._devices[device_id]
+        published_topics = set()
+
+        configs = self._device_configs(device) if device_id not in self._excluded_devices else {}
+
+        for control_id, (control, topic, control_payload) in configs.items():
+            if only_control_id is not None and control_id != only_control_id:
+                continue
+
+            for wb_entity in control.wb_entities:
+                if not wb_entity.availability_published:
+                    self._publish_availability_sync(device_id, wb_entity.id, True)
+
+            logger.info("[%s/%s] publish config to '%s'", device_id, control_id, topic)
             self._publish(topic, json.dumps(control_payload), qos=self._config_qos, retain=self._config_retain)
             self._config_topics[topic] = True
+            published_topics.add(topic)
+
+        if only_control_id is not None:
+            device.config_topics.update(published_topics)
+            return
+
+        # Configs of controls which are gone (or changed their HA type) are cleaned up
+        for topic in sorted(device.config_topics - published_topics):
+            self._config_topics[topic] = False
+        device.config_topics.clear()
+        device.config_topics.update(published_topics)
+
         self.cleanup_discovery()
 
     def _cleanup_discovery_sync(self):
-        for topic, presence in self._config_topics.items():
-            if not presence:
-                self._publish(topic, None, qos=self._config_qos, retain=self._config_retain)
-                del self._config_topics[topic]
+        stale_topics = [topic for topic, presence in self._config_topics.items() if not presence]
+        for topic in stale_topics:
+            self._publish(topic, None, qos=self._config_qos, retain=self._config_retain)
+            del self._config_topics[topic]
+
+    def _clear_availability_sync(self, device_id, control_id):
+        topic = '/devices/' + device_id + '/controls/' + control_id + '/availability'
+        self._publish(topic, None, qos=self._availability_qos, retain=self._availability_retain)
 
     def _publish_availability_sync(self, device_id, control_id, availability):
         payload = '1' if availability else '0'
         topic = '/devices/' + device_id + '/controls/' + control_id + '/availability'
 
-        logger.info(f"[{device_id}/{control_id}] availability: {'online' if availability else 'offline'}")
+        logger.info("[%s/%s] availability: %s", device_id, control_id, 'online' if availability else 'offline')
         self._publish(topic, payload, qos=self._availability_qos, retain=self._availability_retain)
+
+    def _on_control_command(self, command, payload):
+        started = time.monotonic()
+        try:
+            args = json.loads(payload.decode('utf-8')) if payload else {}
+            if not isinstance(args, dict):
+                raise ValueError('Arguments must be a JSON object')
+
+            handler = self._control_commands.get(command)
+            if not handler:
+                raise ValueError(f"Unknown command '{command}'")
+
+            for arg in ('device', 'control'):
+                if args.get(arg) is not None and not isinstance(args[arg], str):
+                    raise ValueError(f"'{arg}' must be a string")
+
+            logger.info('Control command: %s %s', command, args)
+            result = handler(args.get('device'), args.get('control'))
+        except ValueError as e:
+            result = {'error': str(e)}
+
+        if asyncio.iscoroutine(result):
+            async def do_control_command():
+                try:
+                    res = await result
+                except asyncio.CancelledError:
+                    self._publish_control_result(command, {'error': 'Cancelled'}, started)
+                    raise
+                except Exception as e:
+                    logger.exception('Control command %s failed', command)
+                    res = {'error': str(e)}
+                self._publish_control_result(command, res, started)
+
+            self._run_task(f"_control_{command}_", do_control_command())
+        else:
+            self._publish_control_result(command, result, started)
+
+    def _publish_control_result(self, command, result, started):
+        result['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+        topic = self._discovery_prefix + '/' + self._discovery_node_id + '/control/' + command + '/result'
+        self._publish(topic, json.dumps(result), qos=self._control_qos, retain=False)
+
+    def _control_device(self, device_id):
+        if not device_id:
+            raise ValueError("'device' is required")
+        if device_id not in self._devices:
+            raise ValueError(f"Unknown device '{device_id}'")
+        return self._devices[device_id]
+
+    def _control_device_list(self, device_id):
+        return [self._control_device(device_id)] if device_id else list(self._devices.values())
+
+    def _control_dump(self, device_id, control_id):
+        res = {
+            'devices': {
+                device.id: {
+                    'meta': device.meta,
+                    'controls': {control.id: control.meta for control in device.controls.values()},
+                    'config_topics': sorted(device.config_topics),
+                } for device in self._control_device_list(device_id)
+            },
+            'ingest': self.ingest_stats,
+            'refused_devices': list(self._refused_devices),
+        }
+        if self._loop_monitor:
+            res['loop'] = self._loop_monitor.stats()
+        if not device_id:
+            res['config_topics'] = self._config_topics
+        return res
+
+    def _control_diff(self, device_id, control_id):
+        # Arguments are validated before the coroutine is created to report errors right away
+        devices = self._control_device_list(device_id)
+        if self._startup_discovery:
+            raise ValueError('Devices are not subscribed yet')
+        running = self._async_tasks.get('_control_diff_')
+        if running and not running.done():
+            raise ValueError("'diff' is already running")
+        return self._collect_diff(device_id, devices)
+
+    async def _collect_diff(self, device_id, devices):
+        client = self._ingest_client
+        self._diff_markers_sent += 1
+        marker = str(self._diff_markers_sent)
+        self._diff_marker = (marker, asyncio.get_event_loop().create_future())
+        self._retained_configs = {}
+
+        # Broker sends retained configs on subscribe, the marker published after that on the same connection
+        # comes through the ingest queue after all of them
+        self._subscribe_once(client, self.discovery_topic, qos=self._subscribe_qos)
+        self._subscribe_once(client, self.diff_marker_topic, qos=self._subscribe_qos)
+        client.publish(self.diff_marker_topic, marker, qos=self._subscribe_qos, retain=False)
+        try:
+            await asyncio.wait_for(self._diff_marker[1], self._control_diff_timeout_sec)
+        except asyncio.TimeoutError:
+            raise RuntimeError('Retained configs are not received in time') from None
+        finally:
+            self._unsubscribe(client, self.discovery_topic, self.diff_marker_topic)
+            retained, self._retained_configs = self._retained_configs, None
+            self._diff_marker = None
+
+        computed = {}
+        for device in devices:
+            if device.id in self._excluded_devices:
+                continue
+            for _, topic, payload in self._device_configs(device).values():
+                computed[topic] = payload
+
+        res = {
+            'missing': sorted(topic for topic in computed if topic not in retained),
+            'changed': sorted(topic for topic, payload in computed.items() if topic in retained and retained[topic] != payload),
+            'stale': [],
+        }
+        if not device_id:
+            res['stale'] = sorted(topic for topic, payload in retained.items() if payload and topic not in computed)
+        return res
+
+    def _on_diff_marker(self, payload):
+        # Markers of the timed out 'diff' are ignored
+        if self._diff_marker and self._diff_marker[0] == payload and not self._diff_marker[1].done():
+            self._diff_marker[1].set_result(None)
+
+    def _control_republish(self, device_id, control_id):
+        device = self._control_device(device_id)
+        # Controls merged into another entity (e.g. light) have no configs of their own
+        if control_id is not None and control_id not in self._device_configs(device):
+            raise ValueError(f"Unknown control '{control_id}'")
+
+        self._cancel_task(f"{device_id}_config")
+        self._publish_config_sync(device_id, control_id)
+        return {'topics': sorted(device.config_topics)}
+
+    def _control_purge(self, device_id, control_id):
+        device = self._control_device(device_id)
+        if control_id is None:
+            topics = sorted(device.config_topics)
+        else:
+            configs = self._device_configs(device)
+            if control_id not in configs:
+                raise ValueError(f"Unknown control '{control_id}'")
+            topics = [configs[control_id][1]]
+
+        for topic in topics:
+            logger.info("[%s] purge config '%s'", device_id, topic)
+            self._publish(topic, None, qos=self._config_qos, retain=self._config_retain)
+            self._config_topics.pop(topic, None)
+            device.config_topics.discard(topic)
+        return {'topics': sorted(topics)}
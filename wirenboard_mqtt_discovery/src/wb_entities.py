@@ -26,11 +26,17 @@ class WbDevice(WbEntity):
         super().__init__(id)
         self.ha_id = self._normalize_id(id)
         self._controls = {}
+        self._config_topics = set()
+        self.announced_at = None
 
     @property
     def controls(self):
         return self._controls
 
+    @property
+    def config_topics(self):
+        return self._config_topics
+
     def config_payload(self):
         return {
             'name': self.name(),